@@ -4,177 +4,464 @@
 从上次 release tag 到当前 HEAD 的所有 commits，按类型分类生成 markdown
 """
 
+import contextlib
+import functools
+import hashlib
+import os
 import subprocess
 import re
 import sys
-import locale
-from collections import defaultdict
-from typing import Dict, List, Tuple
+import tempfile
+from itertools import chain
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+# 可选依赖：安装了 pygit2 时直接在进程内读取仓库，否则调用 git 命令
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+
+# Commit 类型，按输出顺序排列
+COMMIT_ORDER = ('feat', 'fix', 'perf', 'refactor', 'docs', 'style', 'test', 'build', 'ci', 'chore')
+
+# 分类标题 (纯文本)
+TITLES_PLAIN = {
+    'feat': '新功能',
+    'fix': 'Bug修复',
+    'perf': '性能优化',
+    'refactor': '重构',
+    'docs': '文档',
+    'style': '代码格式',
+    'test': '测试',
+    'build': '构建系统',
+    'ci': 'CI配置',
+    'chore': '其他',
+}
+
+# 分类标题 (带 emoji)
+TITLES_EMOJI = {
+    'feat': '✨ 新功能',
+    'fix': '🐛 Bug修复',
+    'perf': '⚡ 性能优化',
+    'refactor': '♻️ 重构',
+    'docs': '📝 文档',
+    'style': '💄 代码格式',
+    'test': '✅ 测试',
+    'build': '📦 构建系统',
+    'ci': '👷 CI配置',
+    'chore': '🔧 其他',
+}
 
+# 标题样式，通过环境变量 CHANGELOG_STYLE=emoji|plain 选择
+CHANGELOG_STYLE = 'emoji' if os.environ.get('CHANGELOG_STYLE') == 'emoji' else 'plain'
+TITLES = TITLES_EMOJI if CHANGELOG_STYLE == 'emoji' else TITLES_PLAIN
 
 # Commit 类型配置
 COMMIT_TYPES = {
-    'feat': {'title': '新功能', 'order': 1},
-    'fix': {'title': 'Bug修复', 'order': 2},
-    'perf': {'title': '性能优化', 'order': 3},
-    'refactor': {'title': '重构', 'order': 4},
-    'docs': {'title': '文档', 'order': 5},
-    'style': {'title': '代码格式', 'order': 6},
-    'test': {'title': '测试', 'order': 7},
-    'build': {'title': '构建系统', 'order': 8},
-    'ci': {'title': 'CI配置', 'order': 9},
-    'chore': {'title': '其他', 'order': 10},
+    name: {'title': TITLES[name], 'order': order}
+    for order, name in enumerate(COMMIT_ORDER, 1)
+}
+
+# 按 order 排好序的类型，以及类型 (bytes) 到分组下标的映射
+_ORDERED_TYPES = sorted(COMMIT_TYPES.items(), key=lambda kv: kv[1]['order'])
+_TYPE_INDEX = {name.encode('ascii'): i for i, (name, _) in enumerate(_ORDERED_TYPES)}
+
+# 各分类的标题行，与 _ORDERED_TYPES 一一对应
+_HEADERS = tuple('### %s\n\n' % type_info['title'] for _, type_info in _ORDERED_TYPES)
+
+# git 输出和缓存文件统一使用 UTF-8，无法解码的字节替换为 U+FFFD
+ENCODING = 'utf-8'
+ERRORS = 'replace'
+
+# 生成结果的缓存目录 (位于 git 目录下)，最多保留的缓存文件数
+CACHE_DIR_NAME = '.changelog-cache'
+CACHE_MAX_ENTRIES = 16
+
+# 用到的正则表达式，通过 _get_pattern 获取编译结果
+_PATTERNS = {
+    # 匹配 git log -z 输出中的每条记录 (以 NUL 结尾)
+    # 格式: type: description 或 type(scope): description，忽略首尾空白
+    # 大多数 commits 没有 scope，因此先尝试匹配 ': '
+    'commit': rb'(?<![^\x00])\s*(\w+)(?:: |\(([^)\x00]+)\): )([^\x00]*[^\x00\s])\s*\x00',
+    # 缓存文件名 (sha1 十六进制)
+    'cache_key': r'[0-9a-f]{40}',
 }
 
 
-def run_command(cmd: str) -> str:
-    """执行命令并返回输出"""
+class CommitReadError(Exception):
+    """读取提交历史失败 (git 命令异常退出等)，此时的结果不能写入缓存"""
+
+
+@functools.lru_cache(maxsize=None)
+def _get_pattern(kind: str) -> re.Pattern:
+    """获取编译后的正则表达式，每种只编译一次"""
+    return re.compile(_PATTERNS[kind])
+
+
+def _run(args: List[str]) -> str:
+    """执行命令 (不经过 shell) 并返回输出"""
     try:
         result = subprocess.run(
-            cmd,
-            shell=True,
+            args,
             capture_output=True,
             text=True,
-            encoding='utf-8',
-            errors='ignore'
+            encoding=ENCODING,
+            errors=ERRORS,
+            check=False
         )
         return result.stdout.strip() if result.stdout else ""
     except Exception:
-        # 如果失败，返回空字符串
         return ""
 
 
-def get_last_tag() -> str:
-    """获取上一个 tag (最新的已存在 tag，因为新 tag 在 release 步骤才创建)"""
-    # 获取所有 tags，按版本号倒序排列，取第一个（最新的已发布版本）
-    tags = run_command("git tag --sort=-v:refname")
-    if not tags:
-        return None
-    tag_list = [t.strip() for t in tags.split('\n') if t.strip()]
-    # 如果没有 tag，返回 None（首次发布）
-    if len(tag_list) < 1:
-        return None
-    # 返回最新的 tag（上一个版本）
-    return tag_list[0]
+def _run_stream(args: List[str]) -> Iterator[bytes]:
+    """
+    以流的方式执行命令 (不经过 shell)
+    逐块产出原始输出，每块只包含完整的、以 NUL 结尾的记录
+    命令无法执行或以非 0 状态退出时，读完输出后抛出 CommitReadError
+    """
+    try:
+        proc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+    except Exception as e:
+        raise CommitReadError(f"无法执行 {args[0]}: {e}") from e
+
+    with proc:
+        pending = b''
+        for chunk in iter(lambda: proc.stdout.read(65536), b''):
+            end = chunk.rfind(b'\0') + 1
+            if end:
+                yield pending + chunk[:end]
+                pending = chunk[end:]
+            else:
+                pending += chunk
+        # 最后一条记录后面没有 NUL
+        if pending:
+            yield pending + b'\0'
 
+    if proc.returncode != 0:
+        raise CommitReadError(f"退出状态 {proc.returncode}: {' '.join(args)}")
 
-def get_commits_since(since_ref: str = None) -> List[str]:
-    """获取指定引用之后的所有 commits"""
-    if since_ref:
-        cmd = f"git log {since_ref}..HEAD --pretty=format:%s"
-    else:
-        # 如果没有 tag，获取所有 commits
-        cmd = "git log HEAD --pretty=format:%s"
 
-    output = run_command(cmd)
-    return [line.strip() for line in output.split('\n') if line.strip()]
+def open_repository() -> Optional['pygit2.Repository']:
+    """使用 pygit2 打开当前目录所在的仓库，pygit2 不可用或打开失败时返回 None"""
+    if pygit2 is None:
+        return None
+    try:
+        path = pygit2.discover_repository(os.getcwd())
+        return pygit2.Repository(path) if path else None
+    except pygit2.GitError:
+        return None
 
 
-def parse_commit(commit_msg: str) -> Tuple[str, str, str]:
+def _walk_commits(repo: 'pygit2.Repository', tag_id: Optional[str]) -> Iterator[bytes]:
     """
-    解析 commit message
-    返回: (type, scope, description)
+    在进程内遍历 tag_id..HEAD 的非 merge commits
+    逐条产出与 git log -z --pretty=format:%s 相同格式的记录
+    对象缺失 (例如浅克隆) 等错误时抛出 CommitReadError
     """
-    # 匹配格式: type(scope): description 或 type: description
-    pattern = r'^(\w+)(?:\(([^)]+)\))?: (.+)$'
-    match = re.match(pattern, commit_msg)
-
-    if match:
-        commit_type = match.group(1).lower()
-        scope = match.group(2) or ''
-        description = match.group(3)
-        return commit_type, scope, description
+    try:
+        yield from _walk_subjects(repo, tag_id)
+    except (pygit2.GitError, KeyError, ValueError) as e:
+        raise CommitReadError(f"pygit2: {e}") from e
 
-    return None, None, commit_msg
 
+def _walk_subjects(repo: 'pygit2.Repository', tag_id: Optional[str]) -> Iterator[bytes]:
+    """_walk_commits 的实现"""
+    if repo.head_is_unborn:
+        return
 
-def filter_commits(commits: List[str]) -> List[Tuple[str, str, str]]:
-    """过滤并解析 commits"""
-    parsed_commits = []
+    walker = repo.walk(repo.head.target, pygit2.GIT_SORT_NONE)
+    if tag_id:
+        walker.hide(pygit2.Oid(hex=tag_id))
 
-    for commit in commits:
-        # 跳过 merge commits
-        if commit.startswith('Merge '):
+    for commit in walker:
+        if len(commit.parent_ids) > 1:
             continue
 
-        commit_type, scope, description = parse_commit(commit)
+        # 与 %s 一致：subject 为第一段，段内换行替换为空格
+        lines = []
+        for line in commit.raw_message.splitlines():
+            if line.strip():
+                lines.append(line)
+            elif lines:
+                break
+        subject = b' '.join(lines)
+
+        # 与 i18n.logOutputEncoding 一致：按 commit 记录的编码转换为 UTF-8
+        encoding = commit.message_encoding
+        if encoding:
+            try:
+                subject = subject.decode(encoding, ERRORS).encode(ENCODING)
+            except LookupError:
+                pass
+
+        yield subject + b'\0'
+
+
+def get_last_tag() -> Tuple[Optional[str], Optional[str]]:
+    """
+    获取上一个 tag (最新的已存在 tag，因为新 tag 在 release 步骤才创建)
+    两种读取方式都由 git 排序，以保证选出的 tag 一致 (包括 versionsort.suffix 配置)
+    返回: (last_tag, tag 指向的 commit sha)，没有 tag 则为 (None, None)
+    """
+    # 按版本号倒序只取第一个 tag（最新的已发布版本），没有 tag 则为首次发布
+    # 附注 tag 的 %(*objectname) 为其指向的 commit，轻量 tag 则为空
+    output = _run([
+        "git", "for-each-ref", "--sort=-v:refname",
+        "--format=%(refname:short)%00%(objectname)%00%(*objectname)",
+        "--count=1", "refs/tags"
+    ])
+    if not output:
+        return None, None
+    last_tag, object_id, peeled_id = output.split('\0')
+    return last_tag, peeled_id or object_id
+
+
+def collect_commits(tag_id: Optional[str], repo: Optional['pygit2.Repository'] = None) -> Iterator[bytes]:
+    """
+    获取 tag 之后的所有非 merge commits，没有 tag 时获取全部 commits
+    传入 pygit2 仓库时在进程内读取，否则调用 git 命令
+    返回 git log -z 格式的原始输出块
+    """
+    if repo is not None:
+        commits = _walk_commits(repo, tag_id)
+    else:
+        # 不论仓库的 i18n.commitEncoding 如何设置，都让 git 以 UTF-8 输出
+        args = [
+            "git", "-c", "i18n.logOutputEncoding=" + ENCODING,
+            "log", "-z", "--pretty=format:%s", "--no-merges"
+        ]
+        # 如果没有 tag，获取所有 commits
+        args.append(f"{tag_id}..HEAD" if tag_id else "HEAD")
+        commits = _run_stream(args)
+
+    # 边读边处理，不在内存中缓存整个 git log 输出；跳过只有空白的输出
+    return (block for block in commits if block.strip(b' \t\n\r\x0b\x0c\x00'))
+
 
-        # 只保留已知类型的 commits
-        if commit_type and commit_type in COMMIT_TYPES:
-            parsed_commits.append((commit_type, scope, description))
+def get_cache_path(
+    last_tag: Optional[str],
+    tag_id: Optional[str],
+    repo: Optional['pygit2.Repository'] = None
+) -> Optional[Path]:
+    """
+    根据 (脚本内容, 标题样式, last_tag 及其指向的 commit, HEAD) 计算缓存文件路径
+    不在 git 仓库中或还没有任何 commit 时返回 None
+    """
+    if repo is not None:
+        try:
+            if repo.head_is_unborn:
+                return None
+            git_dir, head_sha = repo.path, str(repo.head.target)
+        except pygit2.GitError:
+            return None
+    else:
+        output = _run(["git", "rev-parse", "--git-dir", "HEAD^{commit}"]).split('\n')
+        if len(output) != 2:
+            return None
+
+        git_dir, head_sha = output
+        try:
+            int(head_sha, 16)
+        except ValueError:
+            return None
+
+    # 脚本本身 (类型、标题、输出格式) 修改后缓存随之失效
+    key = hashlib.sha1()
+    try:
+        key.update(Path(__file__).read_bytes())
+    except (NameError, OSError):
+        return None
+    key.update(f"\0{CHANGELOG_STYLE}\0{last_tag or ''}\0{tag_id or ''}\0{head_sha}".encode(ENCODING))
+    return Path(git_dir) / CACHE_DIR_NAME / key.hexdigest()
 
-    return parsed_commits
 
+def prune_cache(cache_dir: Path):
+    """
+    只保留最近写入的 CACHE_MAX_ENTRIES 个缓存文件，清理失败时忽略
+    只处理以缓存 key 命名的文件，其他进程正在写入的临时文件不受影响
+    """
+    is_cache_key = _get_pattern('cache_key').fullmatch
+    try:
+        entries = sorted(
+            (path for path in cache_dir.iterdir() if is_cache_key(path.name)),
+            key=lambda path: path.stat().st_mtime,
+            reverse=True
+        )
+        for path in entries[CACHE_MAX_ENTRIES:]:
+            path.unlink()
+    except OSError:
+        pass
 
-def group_commits_by_type(parsed_commits: List[Tuple[str, str, str]]) -> Dict[str, List[Tuple[str, str]]]:
-    """按类型分组 commits"""
-    grouped = defaultdict(list)
 
-    for commit_type, scope, description in parsed_commits:
-        grouped[commit_type].append((scope, description))
+@contextlib.contextmanager
+def open_output(cache_path: Optional[Path]) -> Iterator[Callable[[str], None]]:
+    """
+    返回同时写入 stdout 和缓存临时文件的 write 函数
+    全部写完后原子地替换缓存文件；缓存不可用或读写出错时只写 stdout
+    """
+    cache_file = None
+    if cache_path:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache_file = tempfile.NamedTemporaryFile(
+                'w', encoding=ENCODING, dir=cache_path.parent, delete=False
+            )
+        except OSError:
+            cache_file = None
+
+    if cache_file is None:
+        yield sys.stdout.write
+        return
 
-    return grouped
+    def discard():
+        # 没有完整写完的缓存不能留下
+        nonlocal cache_file
+        with contextlib.suppress(OSError):
+            cache_file.close()
+        with contextlib.suppress(OSError):
+            os.unlink(cache_file.name)
+        cache_file = None
+
+    def write(text: str):
+        sys.stdout.write(text)
+        if cache_file is not None:
+            try:
+                cache_file.write(text)
+            except OSError:
+                discard()
 
+    try:
+        yield write
+    except BaseException:
+        if cache_file is not None:
+            discard()
+        raise
 
-def generate_changelog(grouped_commits: Dict[str, List[Tuple[str, str]]]) -> str:
-    """生成 markdown 格式的 changelog"""
-    lines = []
+    if cache_file is None:
+        return
+    try:
+        cache_file.close()
+        os.replace(cache_file.name, cache_path)
+    except OSError:
+        discard()
+        return
+    prune_cache(cache_path.parent)
 
-    # 按照定义的顺序输出
-    sorted_types = sorted(
-        grouped_commits.keys(),
-        key=lambda t: COMMIT_TYPES[t]['order']
-    )
 
-    for commit_type in sorted_types:
-        type_info = COMMIT_TYPES[commit_type]
-        commits = grouped_commits[commit_type]
+def collect_grouped(commits: Iterable[bytes]) -> List[List[Tuple[str, str]]]:
+    """
+    解析、过滤 commits 并按类型分组，返回与 _ORDERED_TYPES 一一对应的分组
+    对整块输出做一次正则扫描，只解码匹配到的字段
+    """
+    buckets = [[] for _ in _ORDERED_TYPES]
+    finditer = _get_pattern('commit').finditer
+
+    # merge commits 已由 git log --no-merges 排除
+    for block in commits:
+        for match in finditer(block):
+            commit_type, scope, description = match.groups()
+            # 绝大多数类型本身就是小写，无需再转换
+            if not commit_type.islower():
+                commit_type = commit_type.lower()
+
+            # 只保留已知类型的 commits (在解码前过滤)
+            index = _TYPE_INDEX.get(commit_type)
+            if index is not None:
+                buckets[index].append((
+                    scope.decode(ENCODING, ERRORS) if scope else '',
+                    description.decode(ENCODING, ERRORS)
+                ))
+
+    return buckets
+
+
+def generate_changelog(buckets: List[List[Tuple[str, str]]], write: Callable[[str], None]):
+    """生成 markdown 格式的 changelog，每个分类生成后立即写出"""
+    first = True
+
+    # 分组本身已按照定义的顺序排列
+    for header, commits in zip(_HEADERS, buckets):
+        if not commits:
+            continue
 
-        lines.append(f"### {type_info['title']}\n")
+        if not first:
+            write('\n')  # 空行分隔
+        first = False
+        write(header)
 
         for scope, description in commits:
             if scope:
-                lines.append(f"- **{scope}**: {description}")
+                write('- **%s**: %s\n' % (scope, description))
             else:
-                lines.append(f"- {description}")
+                write('- ' + description + '\n')
 
-        lines.append("")  # 空行分隔
 
-    return '\n'.join(lines)
+def render_output(commits: Iterator[bytes], write: Callable[[str], None]):
+    """根据 commits 生成最终的输出内容并写出"""
+    first = next(commits, None)
+    if first is None:
+        write("## 无更新内容\n")
+        return
+
+    # 解析、过滤并分组
+    grouped = collect_grouped(chain((first,), commits))
+
+    if not any(grouped):
+        write("## 无分类的更新内容\n")
+        return
+
+    # 生成 changelog
+    generate_changelog(grouped, write)
+    write('\n')
 
 
 def main():
     """主函数"""
-    # 获取上次 tag
-    last_tag = get_last_tag()
+    repo = open_repository()
+
+    # 获取上次 tag 及之后的 commits (开始读取 commits 时才会遍历提交历史)
+    last_tag, tag_id = get_last_tag()
+    commits = collect_commits(tag_id, repo)
 
     if last_tag:
         print(f"# 从 {last_tag} 到现在的更新", file=sys.stderr)
     else:
         print("# 首次发布", file=sys.stderr)
 
-    # 获取 commits
-    commits = get_commits_since(last_tag)
-
-    if not commits:
-        print("## 无更新内容")
-        return
-
-    # 解析和过滤
-    parsed_commits = filter_commits(commits)
-
-    if not parsed_commits:
-        print("## 无分类的更新内容")
-        return
-
-    # 分组
-    grouped = group_commits_by_type(parsed_commits)
-
-    # 生成 changelog
-    changelog = generate_changelog(grouped)
-
-    # 输出到 stdout
-    print(changelog)
+    # tag 和 HEAD 都没有变化时直接输出上次的结果；缓存不存在或无法读取时重新生成
+    cache_path = get_cache_path(last_tag, tag_id, repo)
+    if cache_path:
+        try:
+            cached = cache_path.read_text(encoding=ENCODING)
+        except (OSError, UnicodeDecodeError):
+            pass
+        else:
+            sys.stdout.write(cached)
+            return
+
+    # 输出到 stdout，同时写入缓存
+    # render_output 读完全部 commits 后才开始写出，读取失败时不会输出不完整的内容
+    try:
+        with open_output(cache_path) as write:
+            try:
+                render_output(commits, write)
+            except CommitReadError as e:
+                if repo is None:
+                    raise
+                # pygit2 读取失败 (例如浅克隆中缺少对象) 时改用 git 命令重新读取
+                print(f"# 读取提交历史失败，改用 git 命令: {e}", file=sys.stderr)
+                render_output(collect_commits(tag_id), write)
+    except CommitReadError as e:
+        # 失败的结果不写入缓存，输出与没有更新时一致，不中断 release 流程
+        print(f"# 读取提交历史失败: {e}", file=sys.stderr)
+        sys.stdout.write("## 无更新内容\n")
 
 
 if __name__ == '__main__':